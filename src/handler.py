@@ -2,19 +2,27 @@
 RunPod Serverless Handler for WAN 2.1 Seamless Loop Animation Generation
 """
 
-import base64
-import json
+import glob
+import mmap
 import os
-import random
+import re
+import secrets
+import shutil
 import subprocess
 import sys
 import threading
 import time
 import uuid
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
+import orjson
+import pybase64
 import requests
 import runpod
+import websocket
+from PIL import Image
+from requests.adapters import HTTPAdapter
 
 # Configuration
 COMFYUI_PATH = "/workspace/ComfyUI"
@@ -22,6 +30,40 @@ WORKFLOW_PATH = "/workspace/workflow_api.json"
 COMFYUI_PORT = 8188
 INPUT_DIR = os.path.join(COMFYUI_PATH, "input")
 OUTPUT_DIR = os.path.join(COMFYUI_PATH, "output")
+OUTPUT_NODE_ID = "126"  # SaveAnimatedWEBP node in the workflow
+
+# Verbose per-job logging (set HANDLER_DEBUG=1 to enable)
+DEBUG = bool(os.environ.get("HANDLER_DEBUG"))
+
+# Shared HTTP session so localhost ComfyUI calls reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount(
+    f"http://127.0.0.1:{COMFYUI_PORT}",
+    HTTPAdapter(pool_connections=1, pool_maxsize=4),
+)
+SESSION.headers.update({"Connection": "keep-alive"})
+
+# WebSocket client used to receive ComfyUI execution events
+CLIENT_ID = uuid.uuid4().hex
+WS_RECV_TIMEOUT = 30  # seconds per message
+CANCEL_TIMEOUT = 30  # seconds to wait for a cancelled prompt to stop
+
+# Buffer size for streaming URL downloads to disk
+COPY_BUFFER_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60  # seconds to connect / between received bytes
+
+# Base64 input slice size in characters (must be a multiple of 4)
+DECODE_CHUNK_SIZE = 4 * 64 * 1024
+WHITESPACE_RE = re.compile(r"\s")
+
+# Optional S3-compatible storage for outputs (falls back to base64 if unset)
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_ENDPOINT = os.environ.get("S3_ENDPOINT")
+S3_URL_EXPIRY = int(os.environ.get("S3_URL_EXPIRY", 3600))  # seconds
+
+# Workflow template, parsed once at import and never mutated
+with open(WORKFLOW_PATH, "rb") as f:
+    _WORKFLOW_TEMPLATE = orjson.loads(f.read())
 
 
 def start_comfyui():
@@ -44,9 +86,10 @@ def start_comfyui():
     # Wait for server to be ready
     max_wait = 120  # seconds
     start_time = time.time()
+    delay = 0.1
     while time.time() - start_time < max_wait:
         try:
-            response = requests.get(
+            response = SESSION.get(
                 f"http://127.0.0.1:{COMFYUI_PORT}/system_stats", timeout=2
             )
             if response.status_code == 200:
@@ -54,7 +97,8 @@ def start_comfyui():
                 return process
         except requests.exceptions.RequestException:
             pass
-        time.sleep(2)
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
 
     raise RuntimeError("ComfyUI server failed to start within timeout")
 
@@ -65,75 +109,127 @@ def save_input_image(image_data: str, filename: str) -> str:
     filepath = os.path.join(INPUT_DIR, filename)
 
     if image_data.startswith("http://") or image_data.startswith("https://"):
-        # Download from URL
-        response = requests.get(image_data)
-        response.raise_for_status()
-        with open(filepath, "wb") as f:
-            f.write(response.content)
+        # Stream download from URL straight to disk. Uses a one-off request,
+        # not SESSION, so no cookies or connections are shared between jobs.
+        with requests.get(
+            image_data, stream=True, timeout=DOWNLOAD_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(filepath, "wb") as f:
+                shutil.copyfileobj(response.raw, f, length=COPY_BUFFER_SIZE)
     else:
-        # Decode base64
-        # Remove data URL prefix if present
-        if "," in image_data:
-            image_data = image_data.split(",", 1)[1]
-        image_bytes = base64.b64decode(image_data)
+        # Skip data URL prefix if present
+        start = image_data.find(",") + 1
+        # Any whitespace in the payload would misalign chunk boundaries
+        if WHITESPACE_RE.search(image_data, start):
+            image_data = "".join(image_data[start:].split())
+            start = 0
+        # Decode in multiple-of-4 chunks straight to disk
         with open(filepath, "wb") as f:
-            f.write(image_bytes)
+            for i in range(start, len(image_data), DECODE_CHUNK_SIZE):
+                chunk = image_data[i : i + DECODE_CHUNK_SIZE]
+                f.write(pybase64.b64decode(chunk, validate=False))
 
     return filename
 
 
 def load_workflow() -> dict:
-    """Load the workflow template."""
-    with open(WORKFLOW_PATH, "r") as f:
-        return json.load(f)
+    """Return the shared workflow template (read-only, see modify_workflow)."""
+    return _WORKFLOW_TEMPLATE
+
+
+def _patch_node(workflow: dict, node_id: str, **inputs) -> dict:
+    """Return a copy of a workflow node with some inputs overridden."""
+    node = workflow[node_id]
+    return {**node, "inputs": {**node["inputs"], **inputs}}
 
 
 def modify_workflow(workflow: dict, params: dict) -> dict:
-    """Modify workflow with input parameters."""
+    """
+    Return a copy of the workflow with input parameters applied.
+
+    Only the patched nodes are copied; all other nodes are shared with
+    the original, which is left untouched.
+    """
+    workflow = {**workflow}
+
     # Set input image (same for both start and end frame for seamless loop)
     image_filename = params.get("image_filename", "input.png")
-    workflow["52"]["inputs"]["image"] = image_filename
-    workflow["102"]["inputs"]["image"] = image_filename
+    workflow["52"] = _patch_node(workflow, "52", image=image_filename)
+    workflow["102"] = _patch_node(workflow, "102", image=image_filename)
 
     # Set prompt
     prompt = params.get("prompt", "")
-    workflow["6"]["inputs"]["text"] = prompt
+    workflow["6"] = _patch_node(workflow, "6", text=prompt)
 
-    # Set seed
-    seed = params.get("seed", random.randint(0, 2**32 - 1))
-    workflow["3"]["inputs"]["seed"] = seed
+    # Set seed (handler always supplies one; keep the template's otherwise)
+    if "seed" in params:
+        workflow["3"] = _patch_node(workflow, "3", seed=params["seed"])
 
     # Set frame count (default 21, will output 20 after removing last frame)
     frame_count = params.get("frame_count", 21)
-    workflow["59"]["inputs"]["length"] = frame_count
-    workflow["69"]["inputs"]["length"] = frame_count - 1  # Remove last frame for loop
+    workflow["59"] = _patch_node(workflow, "59", length=frame_count)
+    # Remove last frame for loop
+    workflow["69"] = _patch_node(workflow, "69", length=frame_count - 1)
 
     # Set temporal size for VAE decode (frame_count + 7)
-    workflow["61"]["inputs"]["temporal_size"] = frame_count + 7
+    workflow["61"] = _patch_node(workflow, "61", temporal_size=frame_count + 7)
 
-    # Set FPS
+    # Set FPS and unique filename prefix to avoid conflicts
     fps = params.get("fps", 12)
-    workflow["126"]["inputs"]["fps"] = fps
-
-    # Set unique filename prefix to avoid conflicts
-    workflow["126"]["inputs"]["filename_prefix"] = (
-        f"seamless_loop_{uuid.uuid4().hex[:8]}"
+    workflow[OUTPUT_NODE_ID] = _patch_node(
+        workflow,
+        OUTPUT_NODE_ID,
+        fps=fps,
+        filename_prefix=f"seamless_loop_{secrets.token_hex(4)}",
     )
 
     return workflow
 
 
+def get_websocket() -> websocket.WebSocket:
+    """Return the ComfyUI WebSocket, (re)connecting if needed."""
+    global comfyui_ws
+
+    if comfyui_ws is None or not comfyui_ws.connected:
+        comfyui_ws = websocket.create_connection(
+            f"ws://127.0.0.1:{COMFYUI_PORT}/ws?clientId={CLIENT_ID}",
+            timeout=WS_RECV_TIMEOUT,
+        )
+    return comfyui_ws
+
+
+def close_websocket():
+    """Close the ComfyUI WebSocket so the next call reconnects."""
+    global comfyui_ws
+
+    if comfyui_ws is not None:
+        try:
+            comfyui_ws.close()
+        except Exception:
+            pass
+    comfyui_ws = None
+
+
 def queue_prompt(workflow: dict) -> str:
     """Queue a prompt to ComfyUI and return the prompt ID."""
-    payload = {"prompt": workflow}
-    response = requests.post(f"http://127.0.0.1:{COMFYUI_PORT}/prompt", json=payload)
-    result = response.json()
+    payload = {"prompt": workflow, "client_id": CLIENT_ID}
+    response = SESSION.post(
+        f"http://127.0.0.1:{COMFYUI_PORT}/prompt",
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+    )
+    result = orjson.loads(response.content)
 
     # Check for errors in the response
     if "error" in result:
         print(f"ComfyUI error: {result['error']}")
         if "node_errors" in result:
-            print(f"Node errors: {json.dumps(result['node_errors'], indent=2)}")
+            node_errors = orjson.dumps(
+                result["node_errors"], option=orjson.OPT_INDENT_2
+            ).decode()
+            print(f"Node errors: {node_errors}")
         raise RuntimeError(f"ComfyUI rejected prompt: {result['error']}")
 
     if "prompt_id" not in result:
@@ -143,30 +239,126 @@ def queue_prompt(workflow: dict) -> str:
     return result["prompt_id"]
 
 
+def get_history(prompt_id: str) -> Optional[dict]:
+    """Fetch the history entry for a prompt, or None if not available yet."""
+    response = SESSION.get(f"http://127.0.0.1:{COMFYUI_PORT}/history/{prompt_id}")
+    response.raise_for_status()
+    return orjson.loads(response.content).get(prompt_id)
+
+
+def cancel_prompt(prompt_id: str):
+    """Remove a prompt from the ComfyUI queue, or interrupt it if running."""
+    for endpoint, payload in (
+        ("queue", {"delete": [prompt_id]}),
+        ("interrupt", {"prompt_id": prompt_id}),
+    ):
+        try:
+            SESSION.post(
+                f"http://127.0.0.1:{COMFYUI_PORT}/{endpoint}",
+                data=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=5,
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to cancel prompt {prompt_id} via /{endpoint}: {e}")
+
+
+def wait_until_stopped(prompt_id: str, timeout: int = CANCEL_TIMEOUT):
+    """Wait until a prompt is neither running nor pending in ComfyUI."""
+    start_time = time.time()
+    delay = 0.05
+    while time.time() - start_time < timeout:
+        try:
+            response = SESSION.get(f"http://127.0.0.1:{COMFYUI_PORT}/queue", timeout=5)
+            queue = orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError):
+            pass
+        else:
+            # Queue entries are [number, prompt_id, prompt, extra_data, outputs]
+            entries = queue.get("queue_running", []) + queue.get("queue_pending", [])
+            if all(entry[1] != prompt_id for entry in entries):
+                return
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+    print(f"Prompt {prompt_id} still running {timeout}s after cancelling")
+
+
 def wait_for_completion(prompt_id: str, timeout: int = 600) -> dict:
     """Wait for the prompt to complete and return history."""
     start_time = time.time()
+    reconnect_delay = 0.05
 
     while time.time() - start_time < timeout:
         try:
-            response = requests.get(
-                f"http://127.0.0.1:{COMFYUI_PORT}/history/{prompt_id}"
-            )
-            if response.status_code == 200:
-                history = response.json()
-                if prompt_id in history:
-                    return history[prompt_id]
-        except requests.exceptions.RequestException:
-            pass
-        time.sleep(1)
+            message = get_websocket().recv()
+        except websocket.WebSocketTimeoutException:
+            continue
+        except (websocket.WebSocketException, OSError):
+            # Connection dropped - reconnect, then check whether the prompt
+            # finished while we were not listening
+            close_websocket()
+            time.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, 1.0)
+            try:
+                get_websocket()
+                history = get_history(prompt_id)
+            except (websocket.WebSocketException, OSError):
+                continue
+            if history is not None:
+                return history
+            continue
+
+        reconnect_delay = 0.05
+
+        # Binary messages are latent previews
+        if not isinstance(message, str):
+            continue
+
+        msg = orjson.loads(message)
+        data = msg.get("data") or {}
+        if data.get("prompt_id") != prompt_id:
+            continue
+
+        # "node": None signals the prompt finished executing. ComfyUI sends
+        # it after writing history, including on error or interrupt.
+        if msg.get("type") == "executing" and data.get("node") is None:
+            break
+    else:
+        # Stop ComfyUI and wait until it has, so no outputs are written after
+        # the job has been cleaned up
+        cancel_prompt(prompt_id)
+        wait_until_stopped(prompt_id)
+        raise TimeoutError(
+            f"Prompt {prompt_id} did not complete within {timeout} seconds"
+        )
+
+    history = get_history(prompt_id)
+    if history is None:
+        raise RuntimeError(f"No history found for prompt {prompt_id}")
+    return history
 
-    raise TimeoutError(f"Prompt {prompt_id} did not complete within {timeout} seconds")
+
+def _find_output_file(node_output: dict) -> Optional[str]:
+    """Return the first output file path of a node, or None."""
+    # Try "gifs" first (animated output), then "images" as fallback
+    for key in ("gifs", "images"):
+        for file_info in node_output.get(key, ()):
+            filename = file_info.get("filename")
+            subfolder = file_info.get("subfolder", "")
+            if filename:
+                return os.path.join(OUTPUT_DIR, subfolder, filename)
+    return None
 
 
 def get_output_file(history: dict) -> str:
     """Extract the output file path from history."""
-    print(f"History keys: {history.keys()}")
-    print(f"Full history: {json.dumps(history, indent=2, default=str)}")
+    if DEBUG:
+        print(f"History keys: {history.keys()}")
+        full_history = orjson.dumps(
+            history, option=orjson.OPT_INDENT_2, default=str
+        ).decode()
+        print(f"Full history: {full_history}")
 
     # Check for execution errors
     if "status" in history:
@@ -177,39 +369,112 @@ def get_output_file(history: dict) -> str:
             raise RuntimeError(f"ComfyUI execution failed: {error_msg}")
 
     outputs = history.get("outputs", {})
-    print(f"Outputs: {outputs}")
+    if DEBUG:
+        print(f"Outputs: {outputs}")
+
+    # Check the SaveAnimatedWEBP node directly first
+    output_file = _find_output_file(outputs.get(OUTPUT_NODE_ID, {}))
+    if output_file:
+        return output_file
 
-    # Look for SaveAnimatedWEBP output (node 126) - can be in "gifs" or "images"
+    # Fall back to scanning every node
     for node_id, node_output in outputs.items():
-        print(
-            f"Node {node_id} output keys: {node_output.keys() if isinstance(node_output, dict) else node_output}"
-        )
-        # Try "gifs" first (animated output)
-        if "gifs" in node_output:
-            for gif_info in node_output["gifs"]:
-                filename = gif_info.get("filename")
-                subfolder = gif_info.get("subfolder", "")
-                if filename:
-                    return os.path.join(OUTPUT_DIR, subfolder, filename)
-        # Try "images" as fallback
-        if "images" in node_output:
-            for img_info in node_output["images"]:
-                filename = img_info.get("filename")
-                subfolder = img_info.get("subfolder", "")
-                if filename:
-                    return os.path.join(OUTPUT_DIR, subfolder, filename)
+        if DEBUG:
+            print(
+                f"Node {node_id} output keys: {node_output.keys() if isinstance(node_output, dict) else node_output}"
+            )
+        output_file = _find_output_file(node_output)
+        if output_file:
+            return output_file
 
     raise ValueError("No output file found in history")
 
 
 def encode_file_base64(filepath: str) -> str:
-    """Read file and encode as base64."""
-    with open(filepath, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+    """
+    Memory-map file and encode it as base64.
+
+    Encoding straight from the mapping avoids copying the raw file into
+    Python memory. Peak usage is still the encoded bytes plus the
+    returned str (~2.67x file size), as the response needs a str.
+    """
+    if os.path.getsize(filepath) == 0:
+        return ""
+
+    with open(filepath, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        encoded = pybase64.b64encode(mm)
+    return encoded.decode("ascii")
+
+
+def upload_file_s3(filepath: str, job_id: str) -> str:
+    """Upload file to S3 under the job's ID and return a presigned GET URL."""
+    global s3_client
+
+    if s3_client is None:
+        import boto3
+
+        s3_client = boto3.client("s3", endpoint_url=S3_ENDPOINT)
+
+    # The bucket is shared by every worker, so key by the unique job ID
+    key = f"{job_id}/{os.path.basename(filepath)}"
+    s3_client.upload_file(
+        filepath, S3_BUCKET, key, ExtraArgs={"ContentType": "image/webp"}
+    )
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": S3_BUCKET, "Key": key},
+        ExpiresIn=S3_URL_EXPIRY,
+    )
+
+
+def cleanup_files(image_filename: Optional[str], output_prefix: Optional[str]):
+    """Remove the job's input image and any output files ComfyUI wrote."""
+    paths = []
+    if image_filename:
+        paths.append(os.path.join(INPUT_DIR, image_filename))
+    if output_prefix:
+        paths.extend(glob.glob(os.path.join(OUTPUT_DIR, f"{output_prefix}_*")))
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 
+def warmup_comfyui():
+    """Run a tiny prompt so models are loaded before the first real job."""
+    start_time = time.time()
+    image_filename = "warmup.png"
+    os.makedirs(INPUT_DIR, exist_ok=True)
+    Image.new("RGB", (64, 64), (128, 128, 128)).save(
+        os.path.join(INPUT_DIR, image_filename)
+    )
 
-# Global ComfyUI process
+    # Shortest length that still leaves a frame after dropping the last one
+    workflow = modify_workflow(
+        load_workflow(), {"image_filename": image_filename, "frame_count": 5}
+    )
+    output_prefix = workflow[OUTPUT_NODE_ID]["inputs"]["filename_prefix"]
+
+    try:
+        get_websocket()
+        prompt_id = queue_prompt(workflow)
+        get_output_file(wait_for_completion(prompt_id))
+        print(f"ComfyUI warmed up in {time.time() - start_time:.1f}s")
+    finally:
+        cleanup_files(image_filename, output_prefix)
+
+
+# Background workers for output encoding/upload
+EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Global ComfyUI process, WebSocket connection and S3 client
 comfyui_process = None
+comfyui_ws = None
+s3_client = None
 
 
 def handler(job):
@@ -219,6 +484,7 @@ def handler(job):
     Expected input:
     {
         "image": "base64 encoded image or URL",
+        "image_url": "image URL",  # alternative to "image"
         "prompt": "animation description",
         "frame_count": 21,  # optional
         "fps": 12,  # optional
@@ -230,14 +496,24 @@ def handler(job):
         "video": "base64 encoded webp",
         "seed": used_seed
     }
+
+    or, when S3_BUCKET is configured:
+    {
+        "video_url": "presigned URL to the webp",
+        "seed": used_seed
+    }
     """
     global comfyui_process
 
+    image_filename = None
+    output_prefix = None
+
     try:
         job_input = job["input"]
 
         # Validate input
-        if "image" not in job_input:
+        image_data = job_input.get("image") or job_input.get("image_url")
+        if not image_data:
             return {"error": "Missing required field: image"}
 
         # Start ComfyUI if not running
@@ -245,11 +521,13 @@ def handler(job):
             comfyui_process = start_comfyui()
 
         # Save input image
-        image_filename = f"input_{uuid.uuid4().hex[:8]}.png"
-        save_input_image(job_input["image"], image_filename)
+        image_filename = f"input_{secrets.token_hex(4)}.png"
+        save_input_image(image_data, image_filename)
 
         # Prepare parameters
-        seed = job_input.get("seed", random.randint(0, 2**32 - 1))
+        seed = job_input.get("seed")
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), "big")
         params = {
             "image_filename": image_filename,
             "prompt": job_input.get("prompt", ""),
@@ -261,30 +539,41 @@ def handler(job):
         # Load and modify workflow
         workflow = load_workflow()
         workflow = modify_workflow(workflow, params)
+        output_prefix = workflow[OUTPUT_NODE_ID]["inputs"]["filename_prefix"]
+
+        # Connect before queuing so no execution events are missed
+        get_websocket()
 
         # Queue prompt
-        print(f"Queuing prompt with seed {seed}...")
+        if DEBUG:
+            print(f"Queuing prompt with seed {seed}...")
         prompt_id = queue_prompt(workflow)
-        print(f"Prompt ID: {prompt_id}")
+        if DEBUG:
+            print(f"Prompt ID: {prompt_id}")
 
         # Wait for completion
-        print("Waiting for generation to complete...")
+        if DEBUG:
+            print("Waiting for generation to complete...")
         history = wait_for_completion(prompt_id)
 
         # Get output file
         output_file = get_output_file(history)
-        print(f"Output file: {output_file}")
+        if DEBUG:
+            print(f"Output file: {output_file}")
 
-        # Encode output
-        video_base64 = encode_file_base64(output_file)
+        # Upload output if storage is configured, otherwise encode it inline.
+        # Runs in the background while the input image is cleaned up.
+        if S3_BUCKET:
+            output_key = "video_url"
+            output_future = EXECUTOR.submit(upload_file_s3, output_file, job["id"])
+        else:
+            output_key = "video"
+            output_future = EXECUTOR.submit(encode_file_base64, output_file)
 
-        # Cleanup input file
-        try:
-            os.remove(os.path.join(INPUT_DIR, image_filename))
-        except OSError:
-            pass
+        cleanup_files(image_filename, None)
+        image_filename = None
 
-        return {"video": video_base64, "seed": seed}
+        return {output_key: output_future.result(), "seed": seed}
 
     except Exception as e:
         print(f"Error: {e}")
@@ -293,8 +582,19 @@ def handler(job):
         traceback.print_exc()
         return {"error": str(e)}
 
+    finally:
+        # Keep the worker's disk footprint constant across jobs
+        cleanup_files(image_filename, output_prefix)
+
 
 # Start the serverless handler
 if __name__ == "__main__":
     print("Starting WAN 2.1 Seamless Loop Handler...")
+    # Start ComfyUI before accepting jobs so startup isn't billed to the first one
+    comfyui_process = start_comfyui()
+    # Load models now rather than during the first job
+    try:
+        warmup_comfyui()
+    except Exception as e:
+        print(f"Warmup failed, continuing without it: {e}")
     runpod.serverless.start({"handler": handler})
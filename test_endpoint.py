@@ -33,6 +33,15 @@ def save_video(base64_data: str, output_path: str):
     print(f"Saved video to: {output_path}")
 
 
+def download_video(url: str, output_path: str):
+    """Download video from a URL and save to file."""
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    with open(output_path, "wb") as f:
+        f.write(response.content)
+    print(f"Saved video to: {output_path}")
+
+
 def run_generation(
     image_path: str, prompt: str, frame_count: int = 21, fps: int = 12, seed: int = None
 ):
@@ -127,12 +136,17 @@ def main():
     if result:
         # Save the video
         video_data = result.get("video")
+        video_url = result.get("video_url")
         seed = result.get("seed")
+        output_path = f"output_seed_{seed}.webp"
 
         if video_data:
-            output_path = f"output_seed_{seed}.webp"
             save_video(video_data, output_path)
             print(f"Seed used: {seed}")
+        elif video_url:
+            print(f"Video URL: {video_url}")
+            download_video(video_url, output_path)
+            print(f"Seed used: {seed}")
         else:
             print("No video in response!")
             print(result)